@@ -9,6 +9,16 @@ import sys
 import os
 import subprocess
 import re
+from collections import deque
+
+try:
+    import orjson
+
+    def _dumps(obj):
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2).decode()
+except ImportError:
+    def _dumps(obj):
+        return json.dumps(obj, indent=2)
 
 # Maximum number of children to traverse per node (prevents runaway recursion)
 MAX_CHILDREN = 100
@@ -17,31 +27,45 @@ MAX_DEPTH = 10
 # Maximum total nodes to prevent memory issues
 MAX_NODES = 1000
 
+# Patterns for parsing xprop / xdotool output, compiled once at load
+_WM_CLASS_RE = re.compile(r'WM_CLASS\(STRING\) = "([^"]+)"')
+_WM_ROLE_RE = re.compile(r'WM_WINDOW_ROLE\(STRING\) = "([^"]+)"')
+_POS_RE = re.compile(r'Position: (-?\d+),(-?\d+)')
+_GEO_RE = re.compile(r'Geometry: (\d+)x(\d+)')
+
+# AT-SPI cache interface, used to fetch a whole application in one DBus call
+ATSPI_CACHE_PATH = '/org/a11y/atspi/cache'
+ATSPI_CACHE_IFACE = 'org.a11y.atspi.Cache'
+ATSPI_COMPONENT_IFACE = 'org.a11y.atspi.Component'
+ATSPI_ROOT_PATH = '/org/a11y/atspi/accessible/root'
+
 
 def get_window_list():
-    """Fallback: Get window list using wmctrl and xwininfo."""
+    """Fallback: Get window list (with WM_CLASS) from a single wmctrl call."""
     windows = []
     try:
-        # Get window list with geometry
+        # Get window list with geometry and WM_CLASS, so no per-window xprop is needed
         result = subprocess.run(
-            ['wmctrl', '-lG'],
+            ['wmctrl', '-lGx'],
             capture_output=True,
             text=True,
             timeout=5
         )
         if result.returncode == 0:
-            for line in result.result.strip().split('\n'):
-                parts = line.split(None, 6)  # Split by whitespace, max 7 parts
-                if len(parts) >= 7:
+            for line in result.stdout.splitlines():
+                # id, desktop, x, y, width, height, wm_class, host, title
+                parts = line.split(None, 8)
+                if len(parts) >= 8:
                     try:
                         win_id, desktop, x, y, width, height = parts[0], parts[1], int(parts[2]), int(parts[3]), int(parts[4]), int(parts[5])
-                        title = parts[6] if len(parts) > 6 else ''
+                        title = parts[8] if len(parts) > 8 else ''
                         windows.append({
                             'name': title,
                             'role': 'window',
                             'rect': {'x': x, 'y': y, 'width': width, 'height': height},
                             'window_id': win_id,
-                            'desktop': desktop
+                            'desktop': desktop,
+                            'wm_class': parts[6]
                         })
                     except (ValueError, IndexError):
                         continue
@@ -62,11 +86,11 @@ def get_xprop_info(window_id):
         if result.returncode == 0:
             props = {}
             # Extract WM_CLASS
-            match = re.search(r'WM_CLASS\(STRING\) = "([^"]+)"', result.stdout)
+            match = _WM_CLASS_RE.search(result.stdout)
             if match:
                 props['wm_class'] = match.group(1)
             # Extract WM_WINDOW_ROLE
-            match = re.search(r'WM_WINDOW_ROLE\(STRING\) = "([^"]+)"', result.stdout)
+            match = _WM_ROLE_RE.search(result.stdout)
             if match:
                 props['window_role'] = match.group(1)
             return props
@@ -75,24 +99,99 @@ def get_xprop_info(window_id):
     return {}
 
 
+def get_a11y_bus():
+    """Open a Gio connection to the accessibility bus, or None if unavailable."""
+    try:
+        from gi.repository import Gio, GLib
+
+        address = os.environ.get('AT_SPI_BUS_ADDRESS')
+        if not address:
+            session = Gio.bus_get_sync(Gio.BusType.SESSION, None)
+            reply = session.call_sync(
+                'org.a11y.Bus', '/org/a11y/bus', 'org.a11y.Bus', 'GetAddress',
+                None, GLib.VariantType('(s)'), Gio.DBusCallFlags.NONE, 2000, None
+            )
+            address = reply.unpack()[0]
+
+        return Gio.DBusConnection.new_for_address_sync(
+            address,
+            Gio.DBusConnectionFlags.AUTHENTICATION_CLIENT |
+            Gio.DBusConnectionFlags.MESSAGE_BUS_CONNECTION,
+            None, None
+        )
+    except Exception:
+        return None
+
+
+def get_cache_items(bus, bus_name):
+    """Fetch every cached accessible of an application with a single GetItems call."""
+    from gi.repository import Gio
+
+    reply = bus.call_sync(
+        bus_name, ATSPI_CACHE_PATH, ATSPI_CACHE_IFACE, 'GetItems',
+        None, None, Gio.DBusCallFlags.NONE, 5000, None
+    )
+    items = {}
+    child_index = {}
+    for item in reply.unpack()[0]:
+        if len(item) == 10:
+            # (so)(so)(so) i i as s u s au: index in parent + child count
+            (_, path), _, (_, parent), index, child_count, ifaces, name, role, description, states = item
+        elif len(item) == 9:
+            # Older layout with an explicit a(so) children list instead of an index;
+            # a child's index is its position in its parent's list
+            (_, path), _, (_, parent), children, ifaces, name, role, description, states = item
+            for i, (_, child_path) in enumerate(children):
+                child_index[child_path] = i
+            index = None
+            child_count = len(children)
+        else:
+            continue
+        items[path] = (parent, index, child_count, ifaces, name, role, description, states)
+
+    if child_index:
+        # Children missing from their parent's list sort after the listed ones
+        for path, (parent, index, *rest) in items.items():
+            if index is None:
+                items[path] = (parent, child_index.get(path, sys.maxsize), *rest)
+    return items
+
+
 def try_pyatspi():
     """Try to use pyatspi for accessibility tree."""
     try:
         import pyatspi
 
-        node_count = [0]  # Use list for mutable closure
+        # State names repeat across every node; resolve each enum value once
+        state_names = {
+            s: pyatspi.stateToString(s)
+            for s in range(pyatspi.STATE_LAST_DEFINED)
+        }
 
-        def get_node_data(node, depth=0):
-            if depth > MAX_DEPTH or node_count[0] >= MAX_NODES:
-                return None
+        def state_to_string(state):
+            return state_names.get(state) or pyatspi.stateToString(state)
 
-            try:
-                node_count[0] += 1
-                data = {
-                    'name': node.name or '',
-                    'role': node.getRoleName() or 'unknown',
-                    'description': node.description or '',
-                }
+        def build_tree(root, max_nodes):
+            """Walk an accessible subtree breadth-first, emitting at most max_nodes.
+
+            Returns (root_data, node_count).
+            """
+            root_data = None
+            count = 0
+            queue = deque([(root, None, 0)])
+
+            while queue and count < max_nodes:
+                node, parent_data, depth = queue.popleft()
+
+                try:
+                    data = {
+                        'name': node.name or '',
+                        'role': node.getRoleName() or 'unknown',
+                        'description': node.description or '',
+                    }
+                except Exception:
+                    continue
+                count += 1
 
                 # Get component geometry
                 try:
@@ -110,43 +209,150 @@ def try_pyatspi():
                 # Get states
                 try:
                     states = node.getState()
-                    data['states'] = [pyatspi.stateToString(s) for s in states.getStates()]
+                    data['states'] = [state_to_string(s) for s in states.getStates()]
                 except Exception:
                     data['states'] = []
 
-                # Get children (with limits)
-                children = []
+                if parent_data is None:
+                    root_data = data
+                else:
+                    parent_data.setdefault('children', []).append(data)
+
+                # Queue children (with limits); stop once the queue can fill the budget
+                if depth >= MAX_DEPTH:
+                    continue
                 try:
                     child_count = min(node.childCount, MAX_CHILDREN)
                     for i in range(child_count):
+                        if count + len(queue) >= max_nodes:
+                            break
                         try:
                             child = node.getChildAtIndex(i)
                             if child:
-                                child_data = get_node_data(child, depth + 1)
-                                if child_data:
-                                    children.append(child_data)
+                                queue.append((child, data, depth + 1))
                         except Exception:
                             continue
                 except Exception:
                     pass
 
-                if children:
-                    data['children'] = children
+            return root_data, count
+
+        def build_tree_from_cache(bus, app, max_nodes):
+            """Assemble an application's tree locally from its AT-SPI cache.
+
+            Returns (root_data, node_count), or (None, 0) if the cache is empty or
+            is missing children of any node reached (at-spi2-atk does not cache
+            the children of MANAGES_DESCENDANTS/TRANSIENT objects such as lists,
+            trees and tables).
+            """
+            from gi.repository import Atspi, Gio, GLib
+
+            bus_name = app.app.bus_name  # AtspiObject -> AtspiApplication
+            items = get_cache_items(bus, bus_name)
+            if not items:
+                return None, 0
 
-                return data
+            children_of = {}
+            for path, (parent, index, *_rest) in items.items():
+                # The application root is cached too, as a child of the desktop
+                # (whose path is also ATSPI_ROOT_PATH); keep it out of its own children
+                if path == ATSPI_ROOT_PATH:
+                    continue
+                children_of.setdefault(parent, []).append((index, path))
+
+            # A partially populated cache would silently truncate the tree
+            root_children = children_of.get(ATSPI_ROOT_PATH, ())
+            if not root_children or len(root_children) < min(app.childCount, MAX_CHILDREN):
+                return None, 0
+
+            root_data = {
+                'name': app.name or '',
+                'role': app.getRoleName() or 'unknown',
+                'description': app.description or '',
+            }
+            try:
+                root_data['states'] = [state_to_string(s) for s in app.getState().getStates()]
             except Exception:
-                return None
+                root_data['states'] = []
+            count = 1
+            queue = deque([(ATSPI_ROOT_PATH, root_data, 0)])
+
+            while queue and count < max_nodes:
+                path, data, depth = queue.popleft()
+                if depth >= MAX_DEPTH:
+                    continue
+
+                children = children_of.get(path, ())
+                if path != ATSPI_ROOT_PATH and len(children) < min(items[path][2], MAX_CHILDREN):
+                    return None, 0  # Subtree not cached; let the per-node walk handle the app
+
+                for _, child_path in sorted(children)[:MAX_CHILDREN]:
+                    if count >= max_nodes:
+                        break
+                    count += 1
+
+                    _, _, _, ifaces, name, role, description, states = items[child_path]
+                    child_data = {
+                        'name': name or '',
+                        'role': Atspi.role_get_name(role) or 'unknown',
+                        'description': description or '',
+                    }
+
+                    # Geometry is not part of the cache record
+                    if ATSPI_COMPONENT_IFACE in ifaces:
+                        try:
+                            extents = bus.call_sync(
+                                bus_name, child_path, ATSPI_COMPONENT_IFACE, 'GetExtents',
+                                GLib.Variant('(u)', (pyatspi.DESKTOP_COORDS,)),
+                                None, Gio.DBusCallFlags.NONE, 2000, None
+                            )
+                            x, y, width, height = extents.unpack()[0]
+                            child_data['rect'] = {
+                                'x': max(0, x),
+                                'y': max(0, y),
+                                'width': max(0, width),
+                                'height': max(0, height)
+                            }
+                        except Exception:
+                            pass
+
+                    # States arrive as a 64-bit set split into 32-bit words
+                    child_data['states'] = [
+                        state_to_string(word_index * 32 + bit)
+                        for word_index, word in enumerate(states)
+                        for bit in range(32)
+                        if word & (1 << bit)
+                    ]
+
+                    data.setdefault('children', []).append(child_data)
+                    queue.append((child_path, child_data, depth + 1))
+
+            return root_data, count
 
         # Get desktop and traverse applications
         reg = pyatspi.Registry
         desktop = reg.getDesktop(0)
 
+        bus = get_a11y_bus()
+
         apps = []
+        node_count = 0
         for i in range(desktop.childCount):
+            if node_count >= MAX_NODES:
+                break
             try:
                 app = desktop.getChildAtIndex(i)
                 if app and app.name:  # Only include apps with names
-                    app_data = get_node_data(app)
+                    app_data, used = None, 0
+                    # Prefer the bulk cache; fall back to the per-node walk
+                    if bus is not None:
+                        try:
+                            app_data, used = build_tree_from_cache(bus, app, MAX_NODES - node_count)
+                        except Exception:
+                            app_data, used = None, 0
+                    if app_data is None:
+                        app_data, used = build_tree(app, MAX_NODES - node_count)
+                    node_count += used
                     if app_data:
                         apps.append(app_data)
             except Exception:
@@ -162,54 +368,63 @@ def try_pyatspi():
         return {'error': str(e), 'fallback': True}
 
 
+def parse_xdotool_windows(output):
+    """Parse chained `getwindowgeometry %@ getwindowname %@` output."""
+    lines = output.split('\n')
+    geometries = []
+    i = 0
+    # Geometry blocks come first: "Window <id>", "  Position: ...", "  Geometry: ..."
+    # (a name may itself start with "Window ", so also require the Position line)
+    while (i + 2 < len(lines) and lines[i].startswith('Window ')
+           and lines[i + 1].lstrip().startswith('Position:')):
+        x_match = _POS_RE.search(lines[i + 1])
+        s_match = _GEO_RE.search(lines[i + 2])
+        if x_match and s_match:
+            geometries.append((
+                lines[i].split(None, 1)[1].strip(),
+                int(x_match.group(1)), int(x_match.group(2)),
+                int(s_match.group(1)), int(s_match.group(2))
+            ))
+        else:
+            # Keep the slot so names stay aligned with their blocks
+            geometries.append(None)
+        i += 3
+
+    # Followed by one name per window block, in the same order
+    names = lines[i:i + len(geometries)]
+
+    windows = []
+    for index, geometry in enumerate(geometries):
+        if geometry is None:
+            continue
+        win_id, x, y, w, h = geometry
+        name = names[index].strip() if index < len(names) else 'Unknown'
+        windows.append({
+            'name': name,
+            'role': 'window',
+            'rect': {'x': x, 'y': y, 'width': w, 'height': h},
+            'window_id': win_id
+        })
+    return windows
+
+
 def get_x11_tree():
     """Get UI tree using X11 tools as fallback."""
     windows = get_window_list()
 
     if not windows:
-        # Try xdotool as another fallback
+        # Try xdotool as another fallback: one chained invocation reports the
+        # geometry of every visible window, then every name, in stack order
         try:
             result = subprocess.run(
-                ['xdotool', 'search', '--onlyvisible', '.'],
+                ['xdotool', 'search', '--onlyvisible', '.',
+                 'getwindowgeometry', '%@', 'getwindowname', '%@'],
                 capture_output=True,
                 text=True,
                 timeout=5
             )
             if result.returncode == 0:
-                for line in result.stdout.strip().split('\n'):
-                    if line.strip():
-                        try:
-                            win_id = line.strip()
-                            # Get window geometry
-                            geo_result = subprocess.run(
-                                ['xdotool', 'getwindowgeometry', win_id],
-                                capture_output=True,
-                                text=True,
-                                timeout=2
-                            )
-                            if geo_result.returncode == 0:
-                                # Parse geometry output
-                                x_match = re.search(r'Position: (\d+),(\d+)', geo_result.stdout)
-                                s_match = re.search(r'Geometry: (\d+)x(\d+)', geo_result.stdout)
-                                if x_match and s_match:
-                                    x, y = int(x_match.group(1)), int(x_match.group(2))
-                                    w, h = int(s_match.group(1)), int(s_match.group(2))
-                                    # Get window name
-                                    name_result = subprocess.run(
-                                        ['xdotool', 'getwindowname', win_id],
-                                        capture_output=True,
-                                        text=True,
-                                        timeout=2
-                                    )
-                                    name = name_result.stdout.strip() if name_result.returncode == 0 else 'Unknown'
-                                    windows.append({
-                                        'name': name,
-                                        'role': 'window',
-                                        'rect': {'x': x, 'y': y, 'width': w, 'height': h},
-                                        'window_id': win_id
-                                    })
-                        except Exception:
-                            continue
+                windows = parse_xdotool_windows(result.stdout)
         except Exception:
             pass
 
@@ -229,22 +444,22 @@ def main():
     # Try 1: AT-SPI / pyatspi (most detailed)
     result = try_pyatspi()
     if result and not result.get('fallback') and not result.get('error'):
-        print(json.dumps(result, indent=2))
+        print(_dumps(result))
         return 0
 
     # Try 2: X11-based fallback
     result = get_x11_tree()
     if result:
-        print(json.dumps(result, indent=2))
+        print(_dumps(result))
         return 0
 
     # Final fallback: Empty but valid structure
-    print(json.dumps({
+    print(_dumps({
         'type': 'empty',
         'applications': [],
         'error': 'No accessibility information available',
         'message': 'Desktop environment may not support accessibility APIs'
-    }, indent=2))
+    }))
     return 1
 
 
@@ -10,11 +10,21 @@ import base64
 import io
 from typing import List, Dict, Any, Optional, Tuple
 from dataclasses import dataclass, asdict
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 from PIL import Image, ImageDraw, ImageFont
 import subprocess
 import os
 
+try:
+    import orjson
+
+    def _dumps(obj) -> str:
+        return orjson.dumps(obj, option=orjson.OPT_SERIALIZE_NUMPY).decode()
+except ImportError:
+    def _dumps(obj) -> str:
+        return json.dumps(obj)
+
 
 @dataclass
 class DetectedElement:
@@ -53,21 +63,44 @@ class UIElementDetector:
         'window': {'min_area': 10000, 'max_area': 2000000, 'aspect_ratio': (0.5, 2)},
     }
 
+    # ELEMENT_TYPES as an (n_types, 4) table of (min_area, max_area, min_ar, max_ar)
+    _TYPE_NAMES = list(ELEMENT_TYPES)
+    _TYPE_BOUNDS = np.array([
+        [c['min_area'], c['max_area'], c['aspect_ratio'][0], c['aspect_ratio'][1]]
+        for c in ELEMENT_TYPES.values()
+    ], dtype=np.float64)
+
+    # CV passes run on a copy downscaled to at most this width
+    CV_MAX_WIDTH = 1920
+
     def __init__(self):
         self.elements: List[DetectedElement] = []
         self.image: Optional[Image.Image] = None
         self.np_image: Optional[np.ndarray] = None
+        self.gray_image: Optional[np.ndarray] = None
+        self.hsv_image: Optional[np.ndarray] = None
+        self.cv_scale: float = 1.0
 
     def detect_from_screenshot(self, image_path: str) -> List[Dict[str, Any]]:
         """Main entry point: detect all elements from a screenshot"""
         try:
-            self.image = Image.open(image_path).convert('RGB')
-            self.np_image = np.array(self.image)
-
-            # Run multiple detection strategies
-            self._detect_by_contours()
-            self._detect_text_regions()
-            self._detect_clickable_regions()
+            image = Image.open(image_path)
+            if image.mode != 'RGB':
+                image = image.convert('RGB')
+            self.image = image
+            self.np_image = np.asarray(image)
+            self._prepare_color_spaces()
+
+            # Run the independent detection strategies concurrently; OpenCV and
+            # tesseract release the GIL, and OCR dominates wall time
+            with ThreadPoolExecutor(max_workers=3) as executor:
+                futures = [
+                    executor.submit(self._detect_by_contours),
+                    executor.submit(self._detect_text_regions),
+                    executor.submit(self._detect_clickable_regions),
+                ]
+                for future in futures:
+                    self.elements.extend(future.result())
 
             # Merge overlapping detections
             self._merge_overlapping_elements()
@@ -83,15 +116,33 @@ class UIElementDetector:
         except Exception as e:
             return [{'error': str(e)}]
 
-    def _detect_by_contours(self):
-        """Detect UI elements using contour detection"""
+    def _prepare_color_spaces(self):
+        """Downscale and convert the screenshot to grayscale and HSV once for all CV passes"""
         try:
             import cv2
 
-            gray = cv2.cvtColor(self.np_image, cv2.COLOR_RGB2GRAY)
+            width = self.np_image.shape[1]
+            self.cv_scale = min(1.0, self.CV_MAX_WIDTH / width) if width else 1.0
 
-            # Apply bilateral filter to reduce noise while keeping edges
-            blurred = cv2.bilateralFilter(gray, 9, 75, 75)
+            cv_image = self.np_image
+            if self.cv_scale < 1.0:
+                cv_image = cv2.resize(self.np_image, None, fx=self.cv_scale, fy=self.cv_scale,
+                                      interpolation=cv2.INTER_AREA)
+
+            self.gray_image = cv2.cvtColor(cv_image, cv2.COLOR_RGB2GRAY)
+            self.hsv_image = cv2.cvtColor(cv_image, cv2.COLOR_RGB2HSV)
+
+        except ImportError:
+            pass  # OpenCV not available
+
+    def _detect_by_contours(self) -> List[DetectedElement]:
+        """Detect UI elements using contour detection"""
+        elements: List[DetectedElement] = []
+        try:
+            import cv2
+
+            # Light separable blur; UI screenshots have flat regions and no sensor noise
+            blurred = cv2.GaussianBlur(self.gray_image, (3, 3), 0)
 
             # Edge detection
             edges = cv2.Canny(blurred, 50, 150)
@@ -103,95 +154,103 @@ class UIElementDetector:
             # Find contours
             contours, _ = cv2.findContours(dilated, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
 
-            height, width = self.np_image.shape[:2]
+            if not contours:
+                return elements
 
-            for i, contour in enumerate(contours):
-                x, y, w, h = cv2.boundingRect(contour)
+            height, width = self.gray_image.shape[:2]
+            rects = np.array([cv2.boundingRect(c) for c in contours], dtype=np.int64)
+            x, y, w, h = rects.T
 
-                # Skip very small elements
-                if w < 10 or h < 10:
-                    continue
+            # Skip elements at screen edges (likely window borders)
+            keep = (x != 0) & (y != 0) & (x + w < width - 1) & (y + h < height - 1)
 
-                # Skip elements at screen edges (likely window borders)
-                if x == 0 or y == 0 or x + w >= width - 1 or y + h >= height - 1:
-                    continue
+            if self.cv_scale != 1.0:
+                rects = np.round(rects / self.cv_scale).astype(np.int64)
+            w, h = rects[:, 2], rects[:, 3]
+
+            # Skip very small elements
+            keep &= (w >= 10) & (h >= 10)
 
+            # Determine element types based on geometry, all contours at once
+            indices = np.nonzero(keep)[0]
+            element_types = self._classify_by_geometry_batch(w[indices], h[indices])
+
+            for i, element_type in zip(indices.tolist(), element_types):
+                x, y, w, h = rects[i].tolist()
                 area = w * h
-                aspect_ratio = w / h if h > 0 else 0
-
-                # Determine element type based on geometry
-                element_type = self._classify_by_geometry(area, aspect_ratio, w, h)
-
-                if element_type:
-                    confidence = self._calculate_confidence(contour, element_type)
-
-                    element = DetectedElement(
-                        id=f"cv_{i}",
-                        type=element_type,
-                        bbox=(x, y, w, h),
-                        confidence=confidence,
-                        attributes={
-                            'area': area,
-                            'aspect_ratio': aspect_ratio,
-                            'detection_method': 'contour'
-                        }
-                    )
-                    self.elements.append(element)
+                aspect_ratio = w / h
+
+                confidence = self._calculate_confidence(w, h, element_type)
+
+                element = DetectedElement(
+                    id=f"cv_{i}",
+                    type=element_type,
+                    bbox=(x, y, w, h),
+                    confidence=confidence,
+                    attributes={
+                        'area': area,
+                        'aspect_ratio': aspect_ratio,
+                        'detection_method': 'contour'
+                    }
+                )
+                elements.append(element)
 
         except ImportError:
             pass  # OpenCV not available
 
-    def _detect_text_regions(self):
+        return elements
+
+    def _detect_text_regions(self) -> List[DetectedElement]:
         """Detect text regions using OCR"""
+        elements: List[DetectedElement] = []
         try:
             import pytesseract
             from pytesseract import Output
 
             data = pytesseract.image_to_data(self.image, output_type=Output.DICT)
 
-            n_boxes = len(data['text'])
-            for i in range(n_boxes):
-                if int(data['conf'][i]) > 30:  # Confidence threshold
-                    text = data['text'][i].strip()
-                    if len(text) < 2:  # Skip single characters
-                        continue
-
-                    x, y, w, h = data['left'][i], data['top'][i], data['width'][i], data['height'][i]
-
-                    element = DetectedElement(
-                        id=f"ocr_{i}",
-                        type='text',
-                        bbox=(x, y, w, h),
-                        confidence=data['conf'][i] / 100.0,
-                        text=text,
-                        attributes={
-                            'detection_method': 'ocr',
-                            'ocr_confidence': data['conf'][i]
-                        }
-                    )
-                    self.elements.append(element)
+            # Filter all boxes at once: confidence threshold, skip single characters
+            conf = np.asarray(data['conf'], dtype=np.float64).astype(np.int64)
+            texts = np.char.strip(np.asarray(data['text'], dtype=str))
+            mask = (conf > 30) & (np.char.str_len(texts) >= 2)
+
+            for i in np.nonzero(mask)[0].tolist():
+                x, y, w, h = data['left'][i], data['top'][i], data['width'][i], data['height'][i]
+
+                element = DetectedElement(
+                    id=f"ocr_{i}",
+                    type='text',
+                    bbox=(x, y, w, h),
+                    confidence=data['conf'][i] / 100.0,
+                    text=str(texts[i]),
+                    attributes={
+                        'detection_method': 'ocr',
+                        'ocr_confidence': data['conf'][i]
+                    }
+                )
+                elements.append(element)
 
         except ImportError:
             pass  # pytesseract not available
 
-    def _detect_clickable_regions(self):
+        return elements
+
+    def _detect_clickable_regions(self) -> List[DetectedElement]:
         """Detect potentially clickable regions using heuristics"""
+        elements: List[DetectedElement] = []
         try:
             import cv2
 
-            # Convert to HSV for better color analysis
-            hsv = cv2.cvtColor(self.np_image, cv2.COLOR_RGB2HSV)
-
-            # Look for button-like colors (blues, grays)
+            # Look for button-like colors (blues, grays) in the HSV image
             lower_blue = np.array([90, 50, 50])
             upper_blue = np.array([130, 255, 255])
-            blue_mask = cv2.inRange(hsv, lower_blue, upper_blue)
+            blue_mask = cv2.inRange(self.hsv_image, lower_blue, upper_blue)
 
             # Find contours in button-colored regions
             contours, _ = cv2.findContours(blue_mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
 
             for i, contour in enumerate(contours):
-                x, y, w, h = cv2.boundingRect(contour)
+                x, y, w, h = self._to_full_resolution(*cv2.boundingRect(contour))
                 area = w * h
 
                 if area < 500 or area > 50000:
@@ -207,55 +266,61 @@ class UIElementDetector:
                         'area': area
                     }
                 )
-                self.elements.append(element)
+                elements.append(element)
 
         except ImportError:
             pass
 
-    def _classify_by_geometry(self, area: int, aspect_ratio: float, width: int, height: int) -> Optional[str]:
-        """Classify element type based on geometric properties"""
-        for elem_type, criteria in self.ELEMENT_TYPES.items():
-            min_area, max_area = criteria['min_area'], criteria['max_area']
-            min_ar, max_ar = criteria['aspect_ratio']
+        return elements
 
-            if min_area <= area <= max_area and min_ar <= aspect_ratio <= max_ar:
-                # Additional checks for specific types
-                if elem_type == 'checkbox':
-                    if abs(width - height) > 5:  # Checkboxes should be roughly square
-                        continue
-                return elem_type
+    def _to_full_resolution(self, x: int, y: int, w: int, h: int) -> Tuple[int, int, int, int]:
+        """Map a bounding box from the downscaled CV image back to screenshot pixels"""
+        if self.cv_scale == 1.0:
+            return x, y, w, h
 
-        return 'unknown'
+        scale = self.cv_scale
+        return round(x / scale), round(y / scale), round(w / scale), round(h / scale)
 
-    def _calculate_confidence(self, contour, element_type: str) -> float:
-        """Calculate confidence score for a detection"""
-        try:
-            import cv2
+    def _classify_by_geometry_batch(self, widths: np.ndarray, heights: np.ndarray) -> List[str]:
+        """Classify element types from geometry; the first ELEMENT_TYPES entry matching area and aspect ratio wins"""
+        areas = (widths * heights)[:, None]
+        aspect_ratios = np.divide(widths, heights, out=np.zeros(len(widths)), where=heights > 0)[:, None]
 
-            area = cv2.contourArea(contour)
-            perimeter = cv2.arcLength(contour, True)
+        bounds = self._TYPE_BOUNDS
+        matches = ((bounds[:, 0] <= areas) & (areas <= bounds[:, 1]) &
+                   (bounds[:, 2] <= aspect_ratios) & (aspect_ratios <= bounds[:, 3]))
 
-            if perimeter == 0:
-                return 0.5
+        # Checkboxes should be roughly square
+        matches[:, self._TYPE_NAMES.index('checkbox')] &= np.abs(widths - heights) <= 5
 
-            # Circularity: 1 = perfect circle, 0 = irregular
-            circularity = 4 * np.pi * area / (perimeter ** 2)
+        first = matches.argmax(axis=1)
+        found = matches.any(axis=1)
+        return [self._TYPE_NAMES[k] if ok else 'unknown' for k, ok in zip(first.tolist(), found.tolist())]
 
-            # Base confidence
-            base_conf = 0.7
+    def _calculate_confidence(self, width: int, height: int, element_type: str) -> float:
+        """Calculate confidence score for a detection from its bounding box"""
+        area = width * height
+        perimeter = 2 * (width + height)
+        if perimeter == 0:
+            return 0.5
 
-            # Boost for regular shapes (likely UI elements)
-            if circularity > 0.5:
-                base_conf += 0.1
+        # Circularity: 1 = perfect circle, 0 = irregular. Measured on the bounding
+        # rectangle (pi/4 for a square), since UI element contours are close to
+        # axis-aligned rectangles
+        circularity = 4 * np.pi * area / (perimeter ** 2)
 
-            # Boost for certain types
-            if element_type in ['button', 'checkbox']:
-                base_conf += 0.1
+        # Base confidence
+        base_conf = 0.7
 
-            return min(base_conf, 0.95)
+        # Boost for regular shapes (likely UI elements)
+        if circularity > 0.5:
+            base_conf += 0.1
 
-        except:
-            return 0.7
+        # Boost for certain types
+        if element_type in ['button', 'checkbox']:
+            base_conf += 0.1
+
+        return min(base_conf, 0.95)
 
     def _merge_overlapping_elements(self, iou_threshold: float = 0.5):
         """Merge overlapping element detections using NMS-like approach"""
@@ -265,20 +330,46 @@ class UIElementDetector:
         # Sort by confidence
         self.elements.sort(key=lambda x: x.confidence, reverse=True)
 
-        merged = []
-        for elem in self.elements:
-            should_merge = False
-            for kept in merged:
-                iou = self._calculate_iou(elem.bbox, kept.bbox)
-                if iou > iou_threshold:
-                    # Merge: keep the higher confidence one, but combine attributes
-                    should_merge = True
-                    break
+        try:
+            import cv2
+
+            keep = cv2.dnn.NMSBoxes(
+                bboxes=[list(e.bbox) for e in self.elements],
+                scores=[float(e.confidence) for e in self.elements],
+                score_threshold=0.0,
+                nms_threshold=iou_threshold
+            )
+            keep = np.asarray(keep, dtype=np.int64).reshape(-1)
+
+        except ImportError:
+            keep = self._greedy_nms(iou_threshold)
 
-            if not should_merge:
-                merged.append(elem)
+        self.elements = [self.elements[i] for i in keep]
 
-        self.elements = merged
+    def _greedy_nms(self, iou_threshold: float) -> List[int]:
+        """Vectorized greedy NMS over confidence-sorted elements, used without OpenCV"""
+        boxes = np.array([e.bbox for e in self.elements], dtype=np.int64)
+        x1, y1 = boxes[:, 0], boxes[:, 1]
+        x2, y2 = x1 + boxes[:, 2], y1 + boxes[:, 3]
+        areas = boxes[:, 2] * boxes[:, 3]
+
+        # Keep the best remaining box, drop everything overlapping it
+        keep = []
+        remaining = np.arange(len(self.elements))
+        while remaining.size:
+            k = remaining[0]
+            keep.append(k)
+            rest = remaining[1:]
+
+            inter_w = np.maximum(0, np.minimum(x2[k], x2[rest]) - np.maximum(x1[k], x1[rest]))
+            inter_h = np.maximum(0, np.minimum(y2[k], y2[rest]) - np.maximum(y1[k], y1[rest]))
+            inter = inter_w * inter_h
+            union = areas[k] + areas[rest] - inter
+            iou = np.divide(inter, union, out=np.zeros(rest.size), where=union > 0)
+
+            remaining = rest[iou <= iou_threshold]
+
+        return keep
 
     def _calculate_iou(self, bbox1: Tuple[int, int, int, int], bbox2: Tuple[int, int, int, int]) -> float:
         """Calculate Intersection over Union for two bounding boxes"""
@@ -304,8 +395,73 @@ class UIElementDetector:
         return inter_area / union_area
 
 
+# Color map for different element types
+ELEMENT_COLORS = {
+    'button': '#FF6B6B',
+    'input_field': '#4ECDC4',
+    'checkbox': '#45B7D1',
+    'text': '#96CEB4',
+    'icon': '#FFEAA7',
+    'window': '#DDA0DD',
+    'unknown': '#808080',
+    'button_candidate': '#FFB6C1',
+}
+
+
+def _hex_to_bgr(color: str) -> Tuple[int, int, int]:
+    """Convert '#RRGGBB' to an OpenCV BGR tuple"""
+    return int(color[5:7], 16), int(color[3:5], 16), int(color[1:3], 16)
+
+
+ELEMENT_COLORS_BGR = {k: _hex_to_bgr(v) for k, v in ELEMENT_COLORS.items()}
+
+
 def annotate_image(image_path: str, elements: List[Dict], output_path: str):
     """Annotate an image with detected element bounding boxes and IDs"""
+    try:
+        import cv2
+    except ImportError:
+        return _annotate_image_pil(image_path, elements, output_path)
+
+    try:
+        image = cv2.imread(image_path, cv2.IMREAD_COLOR)
+        if image is None:
+            return {'error': f'Could not read image: {image_path}'}
+
+        font = cv2.FONT_HERSHEY_SIMPLEX
+        font_scale = 0.4
+
+        for elem in elements:
+            if 'error' in elem:
+                continue
+
+            x, y, w, h = (int(v) for v in elem.get('bbox', (0, 0, 0, 0)))
+            elem_type = elem.get('type', 'unknown')
+            elem_id = elem.get('id', 'unknown')
+            confidence = elem.get('confidence', 0)
+
+            color = ELEMENT_COLORS_BGR.get(elem_type, ELEMENT_COLORS_BGR['unknown'])
+
+            # Draw rectangle
+            cv2.rectangle(image, (x, y), (x + w, y + h), color, 2)
+
+            # Draw label background and text
+            label = f"{elem_id} ({confidence:.2f})"
+            (text_width, text_height), baseline = cv2.getTextSize(label, font, font_scale, 1)
+            cv2.rectangle(image, (x, y - text_height - baseline - 4), (x + text_width + 4, y), color, -1)
+            cv2.putText(image, label, (x + 2, y - baseline - 2), font, font_scale,
+                        (255, 255, 255), 1, cv2.LINE_AA)
+
+        if not cv2.imwrite(output_path, image):
+            return {'error': f'Could not write {output_path}'}
+        return True
+
+    except Exception as e:
+        return {'error': str(e)}
+
+
+def _annotate_image_pil(image_path: str, elements: List[Dict], output_path: str):
+    """PIL fallback for annotate_image when OpenCV is not available"""
     try:
         image = Image.open(image_path).convert('RGB')
         draw = ImageDraw.Draw(image)
@@ -316,18 +472,6 @@ def annotate_image(image_path: str, elements: List[Dict], output_path: str):
         except:
             font = ImageFont.load_default()
 
-        # Color map for different element types
-        colors = {
-            'button': '#FF6B6B',
-            'input_field': '#4ECDC4',
-            'checkbox': '#45B7D1',
-            'text': '#96CEB4',
-            'icon': '#FFEAA7',
-            'window': '#DDA0DD',
-            'unknown': '#808080',
-            'button_candidate': '#FFB6C1',
-        }
-
         for elem in elements:
             if 'error' in elem:
                 continue
@@ -337,7 +481,7 @@ def annotate_image(image_path: str, elements: List[Dict], output_path: str):
             elem_id = elem.get('id', 'unknown')
             confidence = elem.get('confidence', 0)
 
-            color = colors.get(elem_type, '#808080')
+            color = ELEMENT_COLORS.get(elem_type, '#808080')
 
             # Draw rectangle
             draw.rectangle(
@@ -375,14 +519,14 @@ def annotate_image(image_path: str, elements: List[Dict], output_path: str):
 
 def main():
     if len(sys.argv) < 2:
-        print(json.dumps({'error': 'Usage: element_detector.py <screenshot_path> [annotate_output_path]'})),
+        print(_dumps({'error': 'Usage: element_detector.py <screenshot_path> [annotate_output_path]'})),
         sys.exit(1)
 
     image_path = sys.argv[1]
     annotate_output = sys.argv[2] if len(sys.argv) > 2 else None
 
     if not os.path.exists(image_path):
-        print(json.dumps({'error': f'Image not found: {image_path}'})),
+        print(_dumps({'error': f'Image not found: {image_path}'})),
         sys.exit(1)
 
     detector = UIElementDetector()
@@ -401,7 +545,7 @@ def main():
         else:
             result['annotated_image'] = annotate_output
 
-    print(json.dumps(result))
+    print(_dumps(result))
 
 
 if __name__ == '__main__':
@@ -7,15 +7,153 @@ Based on Microsoft's Set-of-Marks (SoM) technique for grounding multimodal LLMs
 import sys
 import json
 import base64
+import hashlib
+import io
 import os
+import re
+import stat
+import tempfile
 from typing import List, Dict, Any, Tuple, Optional
-from dataclasses import dataclass, asdict
-from PIL import Image, ImageDraw, ImageFont
+from dataclasses import dataclass
+import numpy as np
+from PIL import Image, ImageColor, ImageDraw, ImageFont
 import colorsys
+import functools
 import math
 
+try:
+    import orjson
+
+    _loads = orjson.loads  # orjson.JSONDecodeError subclasses json.JSONDecodeError
+
+    def _dumps(obj: Any, sort_keys: bool = False) -> bytes:
+        return orjson.dumps(obj, option=orjson.OPT_SORT_KEYS if sort_keys else None)
+except ImportError:
+    _loads = json.loads
+
+    def _dumps(obj: Any, sort_keys: bool = False) -> bytes:
+        return json.dumps(obj, sort_keys=sort_keys).encode()
+
+
+def _pairwise_iou(boxes: np.ndarray) -> np.ndarray:
+    """IoU matrix of (x, y, w, h) boxes; only the upper triangle (i < j) is meaningful"""
+    x1, y1, w, h = boxes.T
+    x2, y2 = x1 + w, y1 + h
+    areas = w * h
+
+    # Pairwise IoU matrix in one broadcast
+    inter_w = np.clip(np.minimum(x2[:, None], x2[None, :]) - np.maximum(x1[:, None], x1[None, :]), 0, None)
+    inter_h = np.clip(np.minimum(y2[:, None], y2[None, :]) - np.maximum(y1[:, None], y1[None, :]), 0, None)
+    inter = inter_w * inter_h
+    union = areas[:, None] + areas[None, :] - inter
+    return np.divide(inter, union, out=np.zeros(union.shape), where=union > 0)
+
+
+# On-disk cache of annotation results, keyed by screenshot + element input. It
+# holds full screenshots and click targets, so it is private to the current user
+SOM_CACHE_DIR = os.path.join(tempfile.gettempdir(), f'som_cache-{os.getuid()}')
+SOM_CACHE_MAX_ENTRIES = 64
+# Bump whenever ranking, drawing or the result format changes, so identical
+# inputs stop hitting annotations made by older code
+SOM_CACHE_VERSION = b'som-v1'
+
+
+def _cache_dir() -> Optional[str]:
+    """Create the cache directory (0700); None if it is not a private directory we own"""
+    try:
+        os.mkdir(SOM_CACHE_DIR, 0o700)
+    except FileExistsError:
+        pass
+    except OSError:
+        return None
+
+    try:
+        st = os.lstat(SOM_CACHE_DIR)
+    except OSError:
+        return None
+    if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid() or st.st_mode & 0o077:
+        return None  # Pre-created by someone else or opened up; don't trust its entries
+    return SOM_CACHE_DIR
+
+
+def _cache_key(*parts: Any) -> str:
+    """BLAKE2b digest of the cache version, raw screenshot bytes and JSON-encoded inputs"""
+    digest = hashlib.blake2b(SOM_CACHE_VERSION, digest_size=16)
+    for part in parts:
+        digest.update(part if isinstance(part, bytes) else _dumps(part, sort_keys=True))
+    return digest.hexdigest()
+
+
+def _cache_load(key: str) -> Optional[Dict[str, Any]]:
+    """Return a cached result and mark it recently used, or None on a miss"""
+    cache_dir = _cache_dir()
+    if cache_dir is None:
+        return None
+
+    path = os.path.join(cache_dir, f'{key}.json')
+    try:
+        with open(path, 'rb') as f:
+            result = _loads(f.read())
+        # The caller may already have deleted an annotated PNG written to disk
+        if 'annotated_image_path' in result and not os.path.exists(result['annotated_image_path']):
+            return None
+        os.utime(path)
+        return result
+    except (OSError, ValueError):
+        return None
+
+
+def _cache_store(key: str, result: Dict[str, Any]):
+    """Atomically write a result, evicting the least recently used entries past the cap"""
+    cache_dir = _cache_dir()
+    if cache_dir is None:
+        return
+
+    try:
+        # mkstemp creates the file 0600 under a unique name
+        fd, tmp_path = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(_dumps(result))
+            os.replace(tmp_path, os.path.join(cache_dir, f'{key}.json'))
+        except OSError:
+            os.unlink(tmp_path)
+            raise
+
+        entries = [e for e in os.scandir(cache_dir) if e.name.endswith('.json')]
+        if len(entries) > SOM_CACHE_MAX_ENTRIES:
+            entries.sort(key=lambda e: e.stat().st_mtime)
+            for entry in entries[:len(entries) - SOM_CACHE_MAX_ENTRIES]:
+                os.remove(entry.path)
+    except OSError:
+        pass  # Caching is best effort
+
+
+# Marker fonts, loaded once per process on first use
+_FONT_LARGE: Optional[ImageFont.ImageFont] = None
+_FONT_SMALL: Optional[ImageFont.ImageFont] = None
+
+# Marker number widths for labels 0-100 and the number line height, measured once
+_NUMBER_WIDTHS: List[int] = []
+_NUMBER_HEIGHT = 14
+
+
+def _get_fonts() -> Tuple[ImageFont.ImageFont, ImageFont.ImageFont]:
+    """Return the (large, small) marker fonts, falling back to PIL's default font"""
+    global _FONT_LARGE, _FONT_SMALL, _NUMBER_WIDTHS, _NUMBER_HEIGHT
+    if _FONT_LARGE is None:
+        try:
+            _FONT_LARGE = ImageFont.truetype("/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf", 14)
+            _FONT_SMALL = ImageFont.truetype("/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf", 10)
+        except OSError:
+            _FONT_LARGE = _FONT_SMALL = ImageFont.load_default()
+
+        _NUMBER_WIDTHS = [round(_FONT_LARGE.getlength(str(i))) for i in range(101)]
+        _NUMBER_HEIGHT = getattr(_FONT_LARGE, 'size', _NUMBER_HEIGHT)
+    return _FONT_LARGE, _FONT_SMALL
 
-@dataclass
+
+@dataclass(slots=True)
 class MarkedElement:
     """An element marked for visual prompting"""
     id: int
@@ -51,10 +189,51 @@ class SetOfMarks:
         'dropdown': '#0080FF',      # Light Blue
         'default': '#808080',       # Gray
     }
+    # Pre-parsed RGB tuples for drawing; the legend keeps the hex strings
+    MARKER_COLORS_RGB = {k: ImageColor.getrgb(v) for k, v in MARKER_COLORS.items()}
+    WHITE = (255, 255, 255)
+    LABEL_ALPHA = 180  # Opacity of the label background behind element text
+
+    # Accessibility roles (matched as substrings) that count as interactive
+    INTERACTIVE_ROLES = {
+        'push button', 'button', 'link', 'text', 'entry',
+        'check box', 'radio button', 'combo box', 'menu item',
+        'scroll bar', 'slider', 'tab', 'toggle button',
+        'menu', 'list item', 'tree item', 'table cell'
+    }
+    _INTERACTIVE_ROLE_RE = re.compile('|'.join(map(re.escape, sorted(INTERACTIVE_ROLES))))
+
+    # Accessibility role substrings to element types; the first matching key wins
+    ROLE_MAPPING = {
+        'push button': 'button',
+        'button': 'button',
+        'link': 'link',
+        'text': 'text',
+        'entry': 'input',
+        'check box': 'checkbox',
+        'radio button': 'radio',
+        'combo box': 'dropdown',
+        'menu item': 'menu',
+        'menu': 'menu',
+        'scroll bar': 'scrollbar',
+        'tab': 'tab',
+        'toggle button': 'button',
+        'list item': 'text',
+    }
+    # One lazy-prefixed alternative per key, tried in mapping order
+    _ROLE_RE = re.compile('|'.join(f'.*?({re.escape(key)})' for key in ROLE_MAPPING), re.DOTALL)
+    _ROLE_TYPES = list(ROLE_MAPPING.values())
+
+    # Element types ranked first when choosing which elements to mark
+    _INTERACTIVE_TYPES = frozenset({'button', 'input', 'link'})
 
-    def __init__(self, marker_size: int = 20):
+    def __init__(self, marker_size: int = 20, return_base64: bool = True):
         self.marker_size = marker_size
+        # Base64 for remote LLM payloads; otherwise a PNG path for same-host callers
+        self.return_base64 = return_base64
         self.elements: List[MarkedElement] = []
+        # (bbox, element_type, text, attributes) records gathered from the AXTree
+        self.candidates: List[Tuple[Tuple[int, int, int, int], str, Optional[str], Dict[str, Any]]] = []
         self.image: Optional[Image.Image] = None
         self.width: int = 0
         self.height: int = 0
@@ -71,7 +250,16 @@ class SetOfMarks:
             Dictionary with annotated image path and element mappings
         """
         try:
-            self.image = Image.open(screenshot_path).convert('RGB')
+            with open(screenshot_path, 'rb') as f:
+                screenshot = f.read()
+
+            # Identical screenshot + AXTree (idle frames) returns the previous result
+            cache_key = _cache_key(b'axtree', screenshot, self.marker_size, self.return_base64, axtree_data)
+            cached = _cache_load(cache_key)
+            if cached is not None:
+                return cached
+
+            self.image = Image.open(io.BytesIO(screenshot)).convert('RGB')
             self.width, self.height = self.image.size
 
             # Extract interactive elements from AXTree
@@ -86,14 +274,16 @@ class SetOfMarks:
             # Create element mapping for LLM
             element_map = self._create_element_mapping()
 
-            return {
+            result = {
                 'success': True,
-                'annotated_image': annotated_image,
+                ('annotated_image' if self.return_base64 else 'annotated_image_path'): annotated_image,
                 'element_count': len(self.elements),
-                'elements': [asdict(e) for e in self.elements],
+                'elements': self._serialize_elements(),
                 'element_map': element_map,
                 'legend': self._create_legend(),
             }
+            _cache_store(cache_key, result)
+            return result
 
         except Exception as e:
             return {
@@ -113,7 +303,15 @@ class SetOfMarks:
             Dictionary with annotated image and mappings
         """
         try:
-            self.image = Image.open(screenshot_path).convert('RGB')
+            with open(screenshot_path, 'rb') as f:
+                screenshot = f.read()
+
+            cache_key = _cache_key(b'elements', screenshot, self.marker_size, self.return_base64, elements)
+            cached = _cache_load(cache_key)
+            if cached is not None:
+                return cached
+
+            self.image = Image.open(io.BytesIO(screenshot)).convert('RGB')
             self.width, self.height = self.image.size
 
             # Convert detected elements to MarkedElement
@@ -140,14 +338,16 @@ class SetOfMarks:
             # Create element mapping
             element_map = self._create_element_mapping()
 
-            return {
+            result = {
                 'success': True,
-                'annotated_image': annotated_image,
+                ('annotated_image' if self.return_base64 else 'annotated_image_path'): annotated_image,
                 'element_count': len(self.elements),
-                'elements': [asdict(e) for e in self.elements],
+                'elements': self._serialize_elements(),
                 'element_map': element_map,
                 'legend': self._create_legend(),
             }
+            _cache_store(cache_key, result)
+            return result
 
         except Exception as e:
             return {
@@ -156,124 +356,95 @@ class SetOfMarks:
             }
 
     def _extract_interactive_elements(self, axtree_data: Dict):
-        """Extract interactive elements from AXTree"""
-        interactive_roles = {
-            'push button', 'button', 'link', 'text', 'entry',
-            'check box', 'radio button', 'combo box', 'menu item',
-            'scroll bar', 'slider', 'tab', 'toggle button',
-            'menu', 'list item', 'tree item', 'table cell'
-        }
-
-        def traverse(node: Dict, depth: int = 0):
+        """Extract interactive element candidates from AXTree"""
+        # Start traversal from root
+        if not isinstance(axtree_data, dict):
+            return
+        roots = axtree_data['tree'] if 'tree' in axtree_data else [axtree_data]
+
+        # Explicit pre-order DFS stack; children are pushed reversed so they
+        # pop in document order
+        stack = [(node, 0) for node in reversed(roots)]
+        while stack:
+            node, depth = stack.pop()
             if not isinstance(node, dict):
-                return
+                continue
 
             role = node.get('role', '').lower()
             name = node.get('name', '')
             rect = node.get('rect')
 
             # Check if this is an interactive element
-            is_interactive = any(r in role for r in interactive_roles)
+            is_interactive = self._INTERACTIVE_ROLE_RE.search(role) is not None
             has_valid_rect = rect and all(k in rect for k in ['x', 'y', 'width', 'height'])
             has_content = name or is_interactive
 
             if is_interactive and has_valid_rect and has_content:
-                element = MarkedElement(
-                    id=len(self.elements) + 1,
-                    label=str(len(self.elements) + 1),
-                    bbox=(rect['x'], rect['y'], rect['width'], rect['height']),
-                    center=(rect['x'] + rect['width'] // 2, rect['y'] + rect['height'] // 2),
-                    element_type=self._normalize_role(role),
-                    text=name if name else None,
-                    attributes={
+                # Lightweight record; MarkedElements are only built for ranked survivors
+                self.candidates.append((
+                    (rect['x'], rect['y'], rect['width'], rect['height']),
+                    self._normalize_role(role),
+                    name if name else None,
+                    {
                         'depth': depth,
                         'description': node.get('description'),
                         'states': node.get('states', []),
                     }
-                )
-                self.elements.append(element)
+                ))
 
             # Traverse children
             children = node.get('children', [])
             if isinstance(children, list):
-                for child in children:
-                    traverse(child, depth + 1)
+                stack.extend((child, depth + 1) for child in reversed(children))
 
-        # Start traversal from root
-        if isinstance(axtree_data, dict):
-            if 'tree' in axtree_data:
-                for node in axtree_data['tree']:
-                    traverse(node)
-            else:
-                traverse(axtree_data)
-
-    def _normalize_role(self, role: str) -> str:
+    @staticmethod
+    @functools.lru_cache(maxsize=256)
+    def _normalize_role(role: str) -> str:
         """Normalize accessibility role to our element types"""
-        role_mapping = {
-            'push button': 'button',
-            'button': 'button',
-            'link': 'link',
-            'text': 'text',
-            'entry': 'input',
-            'check box': 'checkbox',
-            'radio button': 'radio',
-            'combo box': 'dropdown',
-            'menu item': 'menu',
-            'menu': 'menu',
-            'scroll bar': 'scrollbar',
-            'tab': 'tab',
-            'toggle button': 'button',
-            'list item': 'text',
-        }
-
-        for key, value in role_mapping.items():
-            if key in role:
-                return value
-
-        return 'default'
+        match = SetOfMarks._ROLE_RE.match(role)
+        return SetOfMarks._ROLE_TYPES[match.lastindex - 1] if match else 'default'
 
     def _filter_and_rank_elements(self):
         """Filter out overlapping elements and rank by importance"""
-        # Remove elements that are too small
-        self.elements = [e for e in self.elements
-                        if e.bbox[2] >= 10 and e.bbox[3] >= 10]  # min 10x10
-
-        # Remove elements that are too large (likely windows/containers)
-        self.elements = [e for e in self.elements
-                        if e.bbox[2] < self.width * 0.8 or e.bbox[3] < self.height * 0.8]
-
-        # Sort by: interactive type > has text > size > depth
-        def importance_score(e: MarkedElement) -> float:
-            score = 0
-
-            # Interactive elements get higher priority
-            if e.element_type in ['button', 'input', 'link']:
-                score += 100
-
-            # Elements with text
-            if e.text:
-                score += 50
-
-            # Reasonable size (not too small, not too big)
-            area = e.bbox[2] * e.bbox[3]
-            if 500 <= area <= 50000:
-                score += 25
-
-            # Penalty for very deep nesting
-            depth = e.attributes.get('depth', 0) if e.attributes else 0
-            score -= depth * 5
-
-            return score
-
-        self.elements.sort(key=importance_score, reverse=True)
-
-        # Reassign IDs after sorting
-        for i, elem in enumerate(self.elements):
-            elem.id = i + 1
-            elem.label = str(i + 1)
-
-        # Limit to 50 most important elements
-        self.elements = self.elements[:50]
+        self.elements = []
+        if not self.candidates:
+            return
+
+        boxes = np.array([c[0] for c in self.candidates], dtype=np.float64)
+        xs, ys, widths, heights = boxes.T
+        areas = widths * heights
+
+        # Drop elements entirely outside the screenshot (e.g. on other monitors)
+        keep = ((xs < self.width) & (ys < self.height) &
+                (xs + widths > 0) & (ys + heights > 0))
+
+        # Remove elements that are too small (min 10x10) or too large (likely windows/containers)
+        keep &= ((widths >= 10) & (heights >= 10) &
+                 ((widths < self.width * 0.8) | (heights < self.height * 0.8)))
+
+        # Score by: interactive type > has text > size > depth
+        is_interactive = np.array([c[1] in self._INTERACTIVE_TYPES for c in self.candidates])
+        has_text = np.array([bool(c[2]) for c in self.candidates])
+        depths = np.array([c[3].get('depth', 0) for c in self.candidates])
+        scores = (100 * is_interactive + 50 * has_text
+                  + 25 * ((areas >= 500) & (areas <= 50000))  # Reasonable size
+                  - 5 * depths)  # Penalty for very deep nesting
+
+        # Limit to 50 most important elements (stable, so ties keep tree order)
+        indices = np.nonzero(keep)[0]
+        ranked = indices[np.argsort(-scores[indices], kind='stable')][:50]
+
+        for i, k in enumerate(ranked.tolist()):
+            bbox, element_type, text, attributes = self.candidates[k]
+            self.elements.append(MarkedElement(
+                id=i + 1,
+                label=str(i + 1),
+                bbox=bbox,
+                center=(bbox[0] + bbox[2] // 2, bbox[1] + bbox[3] // 2),
+                element_type=element_type,
+                text=text,
+                attributes=attributes
+            ))
 
         # Remove heavily overlapping elements
         self._remove_overlapping()
@@ -282,23 +453,26 @@ class SetOfMarks:
         """Remove elements with high overlap, keeping higher priority ones"""
         to_remove = set()
 
-        for i, elem1 in enumerate(self.elements):
-            if i in to_remove:
-                continue
-
-            for j, elem2 in enumerate(self.elements[i + 1:], start=i + 1):
-                if j in to_remove:
+        if len(self.elements) > 1:
+            boxes = np.array([e.bbox for e in self.elements], dtype=np.int64)
+            areas = boxes[:, 2] * boxes[:, 3]
+            iou = _pairwise_iou(boxes)
+
+            # Walk the overlapping pairs (i < j) in nested-loop order; an element
+            # removed mid-row still goes on suppressing the rest of its row
+            overlapping = np.argwhere(np.triu(iou > iou_threshold, k=1))
+            row, skip_row = -1, False
+            for i, j in overlapping.tolist():
+                if i != row:
+                    row, skip_row = i, i in to_remove
+                if skip_row or j in to_remove:
                     continue
 
-                iou = self._calculate_iou(elem1.bbox, elem2.bbox)
-                if iou > iou_threshold:
-                    # Remove the smaller one
-                    area1 = elem1.bbox[2] * elem1.bbox[3]
-                    area2 = elem2.bbox[2] * elem2.bbox[3]
-                    if area1 < area2:
-                        to_remove.add(i)
-                    else:
-                        to_remove.add(j)
+                # Remove the smaller one
+                if areas[i] < areas[j]:
+                    to_remove.add(i)
+                else:
+                    to_remove.add(j)
 
         self.elements = [e for i, e in enumerate(self.elements) if i not in to_remove]
 
@@ -323,41 +497,56 @@ class SetOfMarks:
         return inter_area / union_area if union_area > 0 else 0
 
     def _annotate_image(self) -> str:
-        """Create annotated image with markers"""
-        annotated = self.image.copy()
-        draw = ImageDraw.Draw(annotated)
-
-        # Try to load fonts
-        try:
-            font_large = ImageFont.truetype("/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf", 14)
-            font_small = ImageFont.truetype("/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf", 10)
-        except:
-            font_large = ImageFont.load_default()
-            font_small = font_large
-
-        for elem in self.elements:
-            color = self.MARKER_COLORS.get(elem.element_type, self.MARKER_COLORS['default'])
-            self._draw_marker(draw, elem, color, font_large, font_small)
-
-        # Save annotated image
-        output_path = f"/tmp/som_annotated_{os.getpid()}.png"
-        annotated.save(output_path)
-
-        # Convert to base64
-        with open(output_path, 'rb') as f:
-            base64_image = base64.b64encode(f.read()).decode('utf-8')
+        """Create annotated image with markers, returned as base64 PNG or a temp file path"""
+        # Draw on a transparent overlay so label backgrounds can be semi-transparent,
+        # then composite onto the (single-use, released) screenshot in place
+        screenshot, self.image = self.image, None
+        overlay = Image.new('RGBA', screenshot.size, (0, 0, 0, 0))
+        draw = ImageDraw.Draw(overlay)
+
+        font_large, font_small = _get_fonts()
+
+        colors = self.MARKER_COLORS_RGB
+        layouts = [
+            (colors.get(elem.element_type, colors['default']),
+             self._layout_marker(draw, elem, font_large, font_small))
+            for elem in self.elements
+        ]
+
+        # Draw in passes: bounding boxes, then filled markers, then text on top
+        for color, layout in layouts:
+            draw.rectangle(layout['box'], outline=color, width=2)
+
+        for color, layout in layouts:
+            draw.ellipse(layout['marker'], fill=color, outline=self.WHITE, width=2)
+            draw.rectangle(layout['label_box'], fill=color + (self.LABEL_ALPHA,))
+
+        for _, layout in layouts:
+            draw.text(layout['number_pos'], layout['number'], fill=self.WHITE, font=font_large)
+            draw.text(layout['label_pos'], layout['label'], fill=self.WHITE, font=font_small)
+
+        # Blend through the overlay's own alpha straight into the screenshot, no
+        # full-frame RGBA copies
+        screenshot.paste(overlay, (0, 0), overlay)
+
+        # Fast zlib level since the PNG is consumed, not stored
+        if not self.return_base64:
+            with tempfile.NamedTemporaryFile(prefix='som_', suffix='.png', delete=False) as f:
+                screenshot.save(f, format='PNG', compress_level=1)
+            return f.name
+
+        buffer = io.BytesIO()
+        screenshot.save(buffer, format='PNG', compress_level=1)
+        base64_image = base64.b64encode(buffer.getbuffer()).decode('ascii')
 
         return base64_image
 
-    def _draw_marker(self, draw: ImageDraw, elem: MarkedElement, color: str,
-                     font_large: ImageFont, font_small: ImageFont):
-        """Draw a numbered marker for an element"""
+    def _layout_marker(self, draw: ImageDraw, elem: MarkedElement,
+                       font_large: ImageFont, font_small: ImageFont) -> Dict[str, Any]:
+        """Compute the bounding box, numbered marker and type label geometry for an element"""
         x, y, w, h = elem.bbox
         cx, cy = elem.center
 
-        # Draw bounding box
-        draw.rectangle([x, y, x + w, y + h], outline=color, width=2)
-
         # Calculate marker position (above the element if possible)
         marker_radius = self.marker_size // 2
         marker_y = y - marker_radius - 5
@@ -366,47 +555,53 @@ class SetOfMarks:
 
         marker_x = max(marker_radius + 5, min(cx, self.width - marker_radius - 5))
 
-        # Draw marker circle
-        draw.ellipse(
-            [marker_x - marker_radius, marker_y - marker_radius,
-             marker_x + marker_radius, marker_y + marker_radius],
-            fill=color,
-            outline='white',
-            width=2
-        )
-
-        # Draw marker number
+        # Marker number, centered in the circle
         text = elem.label
-        bbox = draw.textbbox((0, 0), text, font=font_large)
-        text_width = bbox[2] - bbox[0]
-        text_height = bbox[3] - bbox[1]
-
-        draw.text(
-            (marker_x - text_width // 2, marker_y - text_height // 2),
-            text,
-            fill='white',
-            font=font_large
-        )
-
-        # Draw element type label (small, below marker)
+        if elem.id < len(_NUMBER_WIDTHS):
+            text_width = _NUMBER_WIDTHS[elem.id]
+        else:
+            text_width = round(font_large.getlength(text))
+        text_height = _NUMBER_HEIGHT
+
+        # Element type label (small, below the element)
         if elem.text:
             label = elem.text[:20] + '...' if len(elem.text) > 20 else elem.text
         else:
             label = elem.element_type
 
-        label_bbox = draw.textbbox((0, 0), label, font=font_small)
-        label_width = label_bbox[2] - label_bbox[0]
+        # Advance width is all the layout needs; getlength skips textbbox's raster pass
+        label_width = round(font_small.getlength(label))
 
         label_x = max(5, min(cx - label_width // 2, self.width - label_width - 5))
         label_y = y + h + 3
 
-        # Draw semi-transparent background for label
-        draw.rectangle(
-            [label_x - 2, label_y - 1, label_x + label_width + 2, label_y + 10],
-            fill=color
-        )
+        return {
+            'box': [x, y, x + w, y + h],
+            'marker': [marker_x - marker_radius, marker_y - marker_radius,
+                       marker_x + marker_radius, marker_y + marker_radius],
+            'number': text,
+            'number_pos': (marker_x - text_width // 2, marker_y - text_height // 2),
+            'label': label,
+            # Semi-transparent background for label
+            'label_box': [label_x - 2, label_y - 1, label_x + label_width + 2, label_y + 10],
+            'label_pos': (label_x, label_y),
+        }
 
-        draw.text((label_x, label_y), label, fill='white', font=font_small)
+    def _serialize_elements(self) -> List[Dict[str, Any]]:
+        """Plain dicts for the JSON result, without asdict's deep copy of every field"""
+        return [
+            {
+                'id': e.id,
+                'label': e.label,
+                'bbox': e.bbox,
+                'center': e.center,
+                'element_type': e.element_type,
+                'text': e.text,
+                'confidence': e.confidence,
+                'attributes': e.attributes,
+            }
+            for e in self.elements
+        ]
 
     def _create_element_mapping(self) -> Dict[str, Any]:
         """Create a mapping of marker IDs to element info for LLM"""
@@ -435,53 +630,119 @@ class SetOfMarks:
         return legend
 
 
+def _print_json(obj: Any):
+    """Write one JSON document (plus newline) to stdout"""
+    sys.stdout.buffer.write(_dumps(obj) + b'\n')
+    sys.stdout.flush()
+
+
+def _read_payload() -> bytes:
+    """JSON payload from argv[3], or from stdin only when argv[3] is '-'"""
+    if len(sys.argv) <= 3:
+        return b''
+    if sys.argv[3] == '-':
+        return sys.stdin.buffer.read()
+    return sys.argv[3].encode()
+
+
+def _handle_request(request: Dict[str, Any], return_base64: bool = True) -> Dict[str, Any]:
+    """Annotate one server-mode request: {'mode', 'screenshot', 'axtree' | 'elements', ['return_base64']}"""
+    if not isinstance(request, dict):
+        return {'success': False, 'error': 'Request must be a JSON object'}
+
+    mode = request.get('mode')
+    screenshot_path = request.get('screenshot')
+
+    if not isinstance(screenshot_path, str):
+        return {'success': False, 'error': 'Request "screenshot" must be a path string'}
+    if not os.path.exists(screenshot_path):
+        return {'success': False, 'error': f'Screenshot not found: {screenshot_path}'}
+
+    som = SetOfMarks(return_base64=request.get('return_base64', return_base64))
+    if mode == 'axtree':
+        return som.create_marks_from_axtree(screenshot_path, request.get('axtree') or {})
+    if mode == 'elements':
+        return som.create_marks_from_elements(screenshot_path, request.get('elements') or [])
+    return {'success': False, 'error': f'Unknown mode: {mode}. Use "axtree" or "elements"'}
+
+
+def serve(return_base64: bool = True):
+    """Answer JSON-lines requests on stdin until EOF, exactly one JSON line per request line"""
+    for line in sys.stdin.buffer:
+        # The parent matches responses to requests by order, so no line may
+        # go unanswered and no bad request may take the server down
+        try:
+            request = _loads(line)
+        except (ValueError, RecursionError) as e:  # JSONDecodeError, bad UTF-8, deep nesting
+            _print_json({'success': False, 'error': f'Invalid request JSON: {str(e)}'})
+            continue
+
+        try:
+            result = _handle_request(request, return_base64)
+        except Exception as e:
+            result = {'success': False, 'error': str(e)}
+        _print_json(result)
+
+
 def main():
+    # --no-base64: return 'annotated_image_path' to a temp PNG instead of inline base64
+    return_base64 = '--no-base64' not in sys.argv
+    if not return_base64:
+        sys.argv.remove('--no-base64')
+
+    if len(sys.argv) > 1 and sys.argv[1] == '--server':
+        serve(return_base64)
+        return
+
     if len(sys.argv) < 3:
-        print(json.dumps({
-            'error': 'Usage: set_of_marks.py <screenshot_path> <mode> [axtree_json_or_elements_json]'
-        }))
+        _print_json({
+            'error': 'Usage: set_of_marks.py [--no-base64] <screenshot_path> <mode> [axtree_json_or_elements_json | -]'
+                     ' | set_of_marks.py [--no-base64] --server'
+        })
         sys.exit(1)
 
     screenshot_path = sys.argv[1]
     mode = sys.argv[2]  # 'axtree' or 'elements'
 
     if not os.path.exists(screenshot_path):
-        print(json.dumps({'error': f'Screenshot not found: {screenshot_path}'}))
+        _print_json({'error': f'Screenshot not found: {screenshot_path}'})
         sys.exit(1)
 
-    som = SetOfMarks()
+    som = SetOfMarks(return_base64=return_base64)
 
     if mode == 'axtree':
-        if len(sys.argv) < 4:
-            print(json.dumps({'error': 'AXTree JSON required for axtree mode'}))
+        payload = _read_payload()
+        if not payload.strip():
+            _print_json({'error': 'AXTree JSON required for axtree mode'})
             sys.exit(1)
 
         try:
-            axtree_data = json.loads(sys.argv[3])
-        except json.JSONDecodeError as e:
-            print(json.dumps({'error': f'Invalid AXTree JSON: {str(e)}'}))
+            axtree_data = _loads(payload)
+        except (ValueError, RecursionError) as e:
+            _print_json({'error': f'Invalid AXTree JSON: {str(e)}'})
             sys.exit(1)
 
         result = som.create_marks_from_axtree(screenshot_path, axtree_data)
 
     elif mode == 'elements':
-        if len(sys.argv) < 4:
-            print(json.dumps({'error': 'Elements JSON required for elements mode'}))
+        payload = _read_payload()
+        if not payload.strip():
+            _print_json({'error': 'Elements JSON required for elements mode'})
             sys.exit(1)
 
         try:
-            elements = json.loads(sys.argv[3])
-        except json.JSONDecodeError as e:
-            print(json.dumps({'error': f'Invalid elements JSON: {str(e)}'}))
+            elements = _loads(payload)
+        except (ValueError, RecursionError) as e:
+            _print_json({'error': f'Invalid elements JSON: {str(e)}'})
             sys.exit(1)
 
         result = som.create_marks_from_elements(screenshot_path, elements)
 
     else:
-        print(json.dumps({'error': f'Unknown mode: {mode}. Use "axtree" or "elements"'}))
+        _print_json({'error': f'Unknown mode: {mode}. Use "axtree" or "elements"'})
         sys.exit(1)
 
-    print(json.dumps(result))
+    _print_json(result)
 
 
 if __name__ == '__main__':
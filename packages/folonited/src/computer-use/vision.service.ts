@@ -1,5 +1,6 @@
-import { Injectable, Logger } from '@nestjs/common';
-import { exec } from 'child_process';
+import { Injectable, Logger, OnModuleDestroy } from '@nestjs/common';
+import { ChildProcessWithoutNullStreams, exec, spawn } from 'child_process';
+import { createInterface } from 'readline';
 import { promisify } from 'util';
 import * as path from 'path';
 import * as fs from 'fs/promises';
@@ -34,6 +35,11 @@ interface SetOfMarksResult {
   legend: Record<string, string>;
 }
 
+interface SetOfMarksServer {
+  process: ChildProcessWithoutNullStreams;
+  send: (request: Record<string, any>) => Promise<any>;
+}
+
 interface ActionPrediction {
   action: string;
   confidence: number;
@@ -50,9 +56,11 @@ interface StateChange {
 }
 
 @Injectable()
-export class VisionService {
+export class VisionService implements OnModuleDestroy {
   private readonly logger = new Logger(VisionService.name);
   private ocrWorker: Promise<Worker> | null = null;
+  private somServer: SetOfMarksServer | null = null;
+  private readonly SOM_REQUEST_TIMEOUT_MS = 30000;
   private previousState: {
     elements: DetectedElement[];
     timestamp: number;
@@ -61,6 +69,11 @@ export class VisionService {
 
   constructor(private readonly nutService: NutService) {}
 
+  onModuleDestroy() {
+    this.somServer?.process.kill();
+    this.somServer = null;
+  }
+
   /**
    * Initialize OCR worker on first use
    */
@@ -148,29 +161,14 @@ export class VisionService {
 
       if (axtreeData) {
         // Use AXTree data
-        const axtreeJson = JSON.stringify(axtreeData);
-        const { stdout } = await execAsync(
-          `python3 "${scriptPath}" "${screenshotPath}" axtree '${axtreeJson}'`,
-          { timeout: 30000 }
-        );
-        result = JSON.parse(stdout);
+        result = await this.runSetOfMarks(scriptPath, screenshotPath, 'axtree', axtreeData);
       } else if (elements && elements.length > 0) {
         // Use detected elements
-        const elementsJson = JSON.stringify(elements);
-        const { stdout } = await execAsync(
-          `python3 "${scriptPath}" "${screenshotPath}" elements '${elementsJson}'`,
-          { timeout: 30000 }
-        );
-        result = JSON.parse(stdout);
+        result = await this.runSetOfMarks(scriptPath, screenshotPath, 'elements', elements);
       } else {
         // Detect elements first, then create marks
         const detected = await this.detectElements(screenshotPath);
-        const elementsJson = JSON.stringify(detected.elements);
-        const { stdout } = await execAsync(
-          `python3 "${scriptPath}" "${screenshotPath}" elements '${elementsJson}'`,
-          { timeout: 30000 }
-        );
-        result = JSON.parse(stdout);
+        result = await this.runSetOfMarks(scriptPath, screenshotPath, 'elements', detected.elements);
       }
 
       await fs.unlink(screenshotPath).catch(() => {});
@@ -192,6 +190,107 @@ export class VisionService {
     }
   }
 
+  /**
+   * Annotate a screenshot through the long-lived set_of_marks.py --server
+   * process; the payload travels as one JSON line on its stdin
+   */
+  private async runSetOfMarks(
+    scriptPath: string,
+    screenshotPath: string,
+    mode: 'axtree' | 'elements',
+    payload: any,
+  ): Promise<any> {
+    return this.getSomServer(scriptPath).send({
+      mode,
+      screenshot: screenshotPath,
+      [mode]: payload,
+    });
+  }
+
+  /**
+   * Start the set_of_marks.py --server process on first use
+   */
+  private getSomServer(scriptPath: string): SetOfMarksServer {
+    if (this.somServer) {
+      return this.somServer;
+    }
+
+    const server = spawn('python3', [scriptPath, '--server']);
+
+    // Responses arrive in request order, one JSON line each; the queue belongs
+    // to this process so a replacement server never sees its stale output
+    const pending: Array<{
+      resolve: (result: any) => void;
+      reject: (error: Error) => void;
+    }> = [];
+    let timer: NodeJS.Timeout | null = null;
+
+    // Only the request at the head of the queue is running, so time just that
+    // one; a hung request kills the server rather than stalling the queue
+    const armTimer = () => {
+      if (timer) {
+        clearTimeout(timer);
+      }
+      timer = pending.length > 0
+        ? setTimeout(() => server.kill(), this.SOM_REQUEST_TIMEOUT_MS)
+        : null;
+    };
+
+    const shutDown = (error: Error) => {
+      if (this.somServer?.process === server) {
+        this.somServer = null;
+      }
+      if (timer) {
+        clearTimeout(timer);
+        timer = null;
+      }
+      pending.splice(0).forEach(({ reject }) => reject(error));
+    };
+
+    createInterface({ input: server.stdout }).on('line', (line) => {
+      if (this.somServer?.process !== server) {
+        return;
+      }
+      const head = pending.shift();
+      if (!head) {
+        return;
+      }
+      armTimer();
+      try {
+        head.resolve(JSON.parse(line));
+      } catch (error) {
+        head.reject(error);
+      }
+    });
+    server.stderr.on('data', (data) => {
+      this.logger.debug(`set_of_marks: ${data.toString().trim()}`);
+    });
+    server.stdin.on('error', (error) => {
+      server.kill();
+      shutDown(error);
+    });
+    server.on('error', shutDown);
+    server.on('exit', (code) => {
+      shutDown(new Error(`set_of_marks server exited with code ${code}`));
+    });
+
+    const send = (request: Record<string, any>) =>
+      new Promise<any>((resolve, reject) => {
+        if (this.somServer?.process !== server) {
+          reject(new Error('set_of_marks server is not running'));
+          return;
+        }
+        pending.push({ resolve, reject });
+        if (pending.length === 1) {
+          armTimer();
+        }
+        server.stdin.write(JSON.stringify(request) + '\n');
+      });
+
+    this.somServer = { process: server, send };
+    return this.somServer;
+  }
+
   /**
    * Detect state changes between two screenshots
    */